@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 #  This file is part of oh-my-tuna
 #  Copyright (c) 2018 oh-my-tuna's authors
@@ -18,21 +18,12 @@
 
 import subprocess
 import os
-import errno
-import argparse
+import functools
+import itertools
 import re
-import platform
-from contextlib import contextmanager
-
-try:
-    input = raw_input
-except NameError:
-    pass
-
-try:
-    import configparser
-except ImportError:
-    import ConfigParser as configparser
+import shutil
+import stat
+import tempfile
 
 
 mirror_root = "mirrors.tuna.tsinghua.edu.cn"
@@ -41,30 +32,53 @@ always_yes = False
 verbose = False
 is_global = True
 
-os_release_regex = re.compile(r"^ID=\"?([^\"\n]+)\"?$", re.M)
-
-
-@contextmanager
-def cd(path):
-    old_cwd = os.getcwd()
-    os.chdir(path)
-    try:
-        yield
-    finally:
-        os.chdir(old_cwd)
+user_shell = (os.environ.get('SHELL') or '/bin/sh').rsplit('/', 1)[-1]
+shell_profiles = {'bash': '~/.profile', 'sh': '~/.profile', 'zsh': '~/.zprofile'}
+user_profile = shell_profiles.get(user_shell)
+if user_profile:
+    user_profile = os.path.expanduser(user_profile)
+
+arch_mirror_regex = re.compile(
+    r" *Server *= *(http|https)://%s/archlinux/\$repo/os/\$arch\n" %
+    re.escape(mirror_root), re.M)
+# Match commented or not
+arch_mirror_opt_regex = re.compile(
+    r" *(# *)?Server *= *(http|https)://%s/archlinux/\$repo/os/\$arch\n" %
+    re.escape(mirror_root), re.M)
+centos_mirror_regex = re.compile(
+    r"baseurl=https://%s/centos/\$releasever/os/\$basearch/\n" %
+    re.escape(mirror_root), re.M)
+aosc_tuna_regex = re.compile(r"mirrors:.* tuna.*", re.M)
+aosc_origin_regex = re.compile(r"mirrors: origin$", re.M)
+pip_ini_section_regex = re.compile(r"^\[([^\]]+)\]")
+pip_ini_option_regex = re.compile(r"^([^=:\s]+)\s*[=:]\s*(.*)$")
 
 
 def sh(command):
+    """
+    Run an argv tuple without a shell, returns its stdout or None on failure
+    """
     try:
         if verbose:
-            print('$ %s' % command)
-        if isinstance(command, list):
-            command = ' '.join(command)
-        return subprocess.check_output(command, shell=True, stderr=subprocess.STDOUT).decode('utf-8').rstrip()
-    except Exception as e:
+            print('$ %s' % ' '.join(command))
+        # PIPE rather than capture_output, which needs Python 3.7
+        return subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              check=True).stdout.decode('utf-8').rstrip()
+    except (OSError, subprocess.CalledProcessError, UnicodeDecodeError):
         return None
 
 
+@functools.lru_cache(maxsize=128)
+def sh_cached(command):
+    # Only for read-only commands, callers must clear the cache after changes
+    return sh(command)
+
+
+@functools.lru_cache(maxsize=None)
+def _has_tool(name):
+    return shutil.which(name) is not None
+
+
 def user_prompt():
     global always_yes
     if always_yes:
@@ -76,8 +90,9 @@ def user_prompt():
     return ans != 'n'
 
 
-def ask_if_change(name, expected, command_read, command_set):
-    current = sh(command_read)
+def ask_if_change(name, expected, command_read, command_set, current=None):
+    if current is None:
+        current = sh(command_read)
     if current != expected:
         print('%s Before:' % name)
         print(current)
@@ -85,7 +100,8 @@ def ask_if_change(name, expected, command_read, command_set):
         print(expected)
         if user_prompt():
             sh(command_set)
-            print('Command %s succeeded' % command_set)
+            sh_cached.cache_clear()
+            print('Command %s succeeded' % ' '.join(command_set))
             return True
         else:
             return False
@@ -94,57 +110,211 @@ def ask_if_change(name, expected, command_read, command_set):
         return True
 
 
+@functools.lru_cache(maxsize=1)
+def get_os_release():
+    try:
+        with open('/etc/os-release') as f:
+            os_release = f.read()
+    except OSError:
+        return {}
+    release = {}
+    for line in os_release.splitlines():
+        key, sep, value = line.partition('=')
+        if sep:
+            release[key] = value.strip('"\'')
+    return release
+
+
+@functools.lru_cache(maxsize=1)
+def _system():
+    import platform
+    return platform.system()
+
+
 def get_linux_distro():
-    os_release = sh('cat /etc/os-release')
-    if not os_release:
-        return None
-    match = re.findall(os_release_regex, os_release)
-    if len(match) != 1:
-        return None
-    return match[0]
+    return get_os_release().get('ID') or None
+
+
+def _atomic_write(path, data):
+    """
+    Replace a file through a sibling temporary file, so readers never see it half-written
+    """
+    # Write through symlinks such as managed dotfiles instead of replacing them
+    path = os.path.realpath(path)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        st = None
+    if st is not None and st.st_nlink > 1:
+        # Renaming would detach the other hard links, update in place instead
+        with open(path, 'w') as f:
+            f.write(data)
+        return
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.oh-my-tuna-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+            # Make sure data is on disk before the rename makes it visible
+            f.flush()
+            os.fsync(f.fileno())
+        if st is None:
+            os.chmod(tmp, 0o644)
+        else:
+            # Keep the owner, e.g. ~/.profile when running under sudo
+            if hasattr(os, 'chown'):
+                try:
+                    os.chown(tmp, st.st_uid, st.st_gid)
+                except PermissionError:
+                    pass
+            os.chmod(tmp, stat.S_IMODE(st.st_mode))
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+_mirrorlist_cache = {}
+
+
+def _read_mirrorlist():
+    """
+    Returns lines of pacman mirrorlist, reread only if the file has changed
+    """
+    st = os.stat('/etc/pacman.d/mirrorlist')
+    key = (st.st_mtime, st.st_size)
+    if _mirrorlist_cache.get('key') != key:
+        with open('/etc/pacman.d/mirrorlist', 'r') as ml:
+            _mirrorlist_cache['lines'] = ml.readlines()
+        _mirrorlist_cache['key'] = key
+    return _mirrorlist_cache['lines']
+
+
+def _write_mirrorlist(content):
+    """
+    Replace pacman mirrorlist with content, skipped if nothing would change
+    """
+    if content == ''.join(_read_mirrorlist()):
+        return
+    _atomic_write('/etc/pacman.d/mirrorlist', content)
+    _mirrorlist_cache.clear()
+
+
+def _rewrite_profile(path, key, value=None):
+    """
+    Drop all `export key=` lines from a shell profile, then append one if value is given
+    """
+    prefix = 'export %s=' % key
+    try:
+        with open(path) as f:
+            lines = [l for l in f if not l.startswith(prefix)]
+    except FileNotFoundError:
+        lines = []
+    if value is not None:
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        lines.append('%s%s\n' % (prefix, value))
+    _atomic_write(path, ''.join(lines))
+
+
+def _read_pip_ini(path):
+    """
+    Returns {section: {key: value}} of a pip config file, comments are dropped
+    Follows configparser, which pip uses: options may be indented, keys are
+    lowercased, and lines indented deeper than their option continue its value
+    """
+    data = {}
+    section = key = None
+    key_indent = 0
+    try:
+        with open(path) as f:
+            for line in f:
+                value = line.strip()
+                if not value or value[0] in '#;':
+                    continue
+                indent = len(line) - len(line.lstrip())
+                if key is not None and indent > key_indent:
+                    # Continuation of a multi-line value
+                    section[key] = (section[key] + '\n' + value).lstrip('\n')
+                    continue
+                match = pip_ini_section_regex.match(value)
+                if match:
+                    section = data.setdefault(match.group(1).strip(), {})
+                    key = None
+                    continue
+                match = pip_ini_option_regex.match(value)
+                if match and section is not None:
+                    key = match.group(1).lower()
+                    key_indent = indent
+                    section[key] = match.group(2).rstrip()
+                else:
+                    key = None
+    except FileNotFoundError:
+        pass
+    return data
+
+
+def _write_pip_ini(path, data):
+    lines = []
+    for name, options in data.items():
+        lines.append('[%s]\n' % name)
+        for key, value in options.items():
+            lines.append('%s = %s\n' % (key, value.replace('\n', '\n    ')))
+        lines.append('\n')
+    _atomic_write(path, ''.join(lines))
 
 
 def set_env(key, value):
-    shell = os.environ.get('SHELL').split('/')[-1]
-    if shell == 'bash' or shell == 'sh':
-        with open(os.path.expanduser('~/.profile'), 'a') as f:
-            f.write('export %s=%s\n' % (key, value))
-    elif shell == 'zsh':
-        with open(os.path.expanduser('~/.zprofile'), 'a') as f:
-            f.write('export %s=%s\n' % (key, value))
+    if user_profile:
+        _rewrite_profile(user_profile, key, value)
     else:
         print('Please set %s=%s' % (key, value))
 
 
 def remove_env(key):
-    shell = os.environ.get('SHELL').split('/')[-1]
-    if shell == 'bash' or shell == 'sh':
-        pattern = "^export %s=" % key
-        profile = "~/.profile"
-    elif shell == 'zsh':
-        pattern = "^export %s=" % key
-        profile = "~/.zprofile"
-    if pattern:
-        profile = os.path.expanduser(profile)
-        if platform.system() == 'Darwin': # TODO: More BSD systems
-            sed = ['sed', '-i', "", "/%s/d" % pattern, profile]
-        else:
-            sed = ['sed', '-i', "/%s/d" % pattern, profile]
-        sh(sed)
-        return True
-    else:
+    if not user_profile:
         print('Please remove environment variable %s' % key)
         return False
+    _rewrite_profile(user_profile, key)
+    return True
 
 
-def mkdir_p(path):
+def _git_origin(path):
+    """
+    Returns origin url of a git repository, read from git config files when possible
+    Falls back to git itself whenever url rewrites (insteadOf) or includes may apply,
+    system config outside /etc/gitconfig is not inspected
+    """
+    import configparser
+    get_url = ('git', '-C', path, 'remote', 'get-url', 'origin')
+    if any(k in os.environ for k in ('GIT_DIR', 'GIT_CONFIG_GLOBAL', 'GIT_CONFIG_SYSTEM', 'GIT_CONFIG_COUNT')):
+        return sh_cached(get_url)
+    xdg_config = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+    # Same precedence as git: system, global, then repository wins
+    config_files = ('/etc/gitconfig',
+                    os.path.join(xdg_config, 'git', 'config'),
+                    os.path.expanduser('~/.gitconfig'),
+                    os.path.join(path, '.git', 'config'))
+    config = configparser.RawConfigParser(strict=False, allow_no_value=True)
     try:
-        os.makedirs(path)
-    except OSError as exc:
-        if exc.errno == errno.EEXIST and os.path.isdir(path):
-            pass
-        else:
-            raise
+        config.read(config_files)
+        url = config.get('remote "origin"', 'url')
+    except configparser.Error:
+        return sh_cached(get_url)
+    if any(s.lower().startswith(('url ', 'include')) for s in config.sections()):
+        return sh_cached(get_url)
+    return url
+
+
+def cp(src, dst):
+    try:
+        shutil.copy(src, dst)
+        return True
+    except OSError:
+        return False
+
+
+def mkdir_p(path):
+    os.makedirs(path, exist_ok=True)
 
 
 
@@ -229,14 +399,19 @@ class Pypi(Base):
     Reference: https://pip.pypa.io/en/stable/user_guide/#configuration
     """
     @staticmethod
+    @functools.lru_cache(maxsize=1)
     def config_files():
-        system = platform.system()
+        system = _system()
         if system == 'Darwin':
-            return ('$HOME/Library/Application Support/pip/pip.conf', '$HOME/.pip/pip.conf')
+            files = ('$HOME/Library/Application Support/pip/pip.conf', '$HOME/.pip/pip.conf')
         elif system == 'Windows':
-            return (r'%APPDATA%\pip\pip.ini', r'~\pip\pip.ini')
+            files = (r'%APPDATA%\pip\pip.ini', r'~\pip\pip.ini')
         elif system == 'Linux':
-            return ('$HOME/.config/pip/pip.conf', '$HOME/.pip/pip.conf')
+            files = ('$HOME/.config/pip/pip.conf', '$HOME/.pip/pip.conf')
+        else:
+            return ()
+        # Expanded once, environment does not change during a run
+        return tuple(os.path.expanduser(os.path.expandvars(f)) for f in files)
 
 
     @staticmethod
@@ -250,54 +425,38 @@ class Pypi(Base):
         if is_global:
             # Skip if in global mode
             return False
-        return sh('pip') is not None or sh('pip3') is not None
+        return _has_tool('pip') or _has_tool('pip3')
+
+
+    @staticmethod
+    def uses_mirror(config):
+        # Shared by is_online() and down(), so down() always undoes what counts as online
+        return config.get('global', {}).get('index-url') == Pypi.mirror_url
 
 
     @staticmethod
     def is_online():
-        pattern = re.compile(r' *index-url *= *%s' % Pypi.mirror_url)
-        config_files = Pypi.config_files()
-        for conf_file in config_files:
-            if not os.path.exists(os.path.expandvars(conf_file)):
-                continue
-            with open(os.path.expandvars(conf_file)) as f:
-                for line in f:
-                    if pattern.match(line):
-                        return True
-        return False
+        return any(Pypi.uses_mirror(_read_pip_ini(conf_file)) for conf_file in Pypi.config_files())
 
 
     @staticmethod
     def up():
-        config_file = os.path.expandvars(Pypi.config_files()[0])
-        config = configparser.ConfigParser()
-        if os.path.exists(config_file):
-            config.read(config_file)
-        if not config.has_section('global'):
-            config.add_section('global')
+        config_file = Pypi.config_files()[0]
+        config = _read_pip_ini(config_file)
+        config.setdefault('global', {})['index-url'] = Pypi.mirror_url
         if not os.path.isdir(os.path.dirname(config_file)):
             mkdir_p(os.path.dirname(config_file))
-        config.set('global', 'index-url', Pypi.mirror_url)
-        with open(config_file, 'w') as f:
-            config.write(f)
+        _write_pip_ini(config_file, config)
         return True
 
 
     @staticmethod
     def down():
-        config_files = map(os.path.expandvars, Pypi.config_files())
-        config = configparser.ConfigParser()
-        for path in config_files:
-            if not os.path.exists(path):
-                continue
-            config.read(path)
-            try:
-                if config.get('global', 'index-url') == Pypi.mirror_url:
-                    config.remove_option('global', 'index-url')
-                with open(path, 'w') as f:
-                    config.write(f)
-            except (configparser.NoOptionError, configparser.NoSectionError):
-                pass
+        for path in Pypi.config_files():
+            config = _read_pip_ini(path)
+            if Pypi.uses_mirror(config):
+                del config['global']['index-url']
+                _write_pip_ini(path, config)
         return True
 
 
@@ -316,22 +475,10 @@ class ArchLinux(Base):
 
     @staticmethod
     def is_online():
-        mirror_re = re.compile(
-            r" *Server *= *(http|https)://%s/archlinux/\$repo/os/\$arch\n" %
-            mirror_root, re.M)
-        ml = open('/etc/pacman.d/mirrorlist', 'r')
-        lines = ml.readlines()
-        result = map(lambda l: re.match(mirror_re, l), lines)
-        result = any(result)
-        ml.close()
-        return result
+        return any(map(arch_mirror_regex.match, _read_mirrorlist()))
 
     @staticmethod
     def up():
-        # Match commented or not
-        mirror_re = re.compile(
-            r" *(# *)?Server *= *(http|https)://%s/archlinux/\$repo/os/\$arch\n"
-            % mirror_root, re.M)
         banner = '# Generated and managed by the awesome oh-my-tuna\n'
         target = "Server = https://%s/archlinux/$repo/os/$arch\n\n" % mirror_root
 
@@ -341,30 +488,16 @@ class ArchLinux(Base):
         if not user_prompt():
             return False
 
-        ml = open('/etc/pacman.d/mirrorlist', 'r')
-        lines = ml.readlines()
-
-        # Remove all
-        lines = filter(lambda l: re.match(mirror_re, l) is None, lines)
-
-        # Remove banner
-        lines = filter(lambda l: l != banner, lines)
-
-        # Finish reading
-        lines = list(lines)
+        # Remove all existing TUNA mirrors and banner
+        lines = (l for l in _read_mirrorlist()
+                 if l != banner and arch_mirror_opt_regex.match(l) is None)
 
         # Remove padding newlines
-        k = 0
-        while k < len(lines) and lines[k] == '\n':
-            k += 1
+        lines = itertools.dropwhile(lambda l: l == '\n', lines)
 
-        ml.close()
-        ml = open('/etc/pacman.d/mirrorlist', 'w')
         # Add target
-        ml.write(banner)
-        ml.write(target)
-        ml.writelines(lines[k:])
-        ml.close()
+        content = ''.join((banner, target, *lines))
+        _write_mirrorlist(content)
         return True
 
     @staticmethod
@@ -376,40 +509,41 @@ class ArchLinux(Base):
             return False
 
         # Simply remove all matched lines
-        mirror_re = re.compile(
-            r" *Server *= *(http|https)://%s/archlinux/\$repo/os/\$arch\n" %
-            mirror_root, re.M)
-
-        ml = open('/etc/pacman.d/mirrorlist', 'r')
-        lines = ml.readlines()
-        lines = list(
-            map(lambda l: l if re.match(mirror_re, l) is None else '# ' + l,
-                lines))
-        ml.close()
-        ml = open('/etc/pacman.d/mirrorlist', 'w')
-        ml.writelines(lines)
-        ml.close()
+        content = ''.join(
+            l if arch_mirror_regex.match(l) is None else '# ' + l
+            for l in _read_mirrorlist())
+        _write_mirrorlist(content)
         return True
 
 
 class Homebrew(Base):
+    taps = ('homebrew-core', 'homebrew-python', 'homebrew-science')
+
     @staticmethod
     def name():
         return 'Homebrew'
 
+    @staticmethod
+    def installed_taps(repo):
+        try:
+            existing = {e.name for e in os.scandir('%s/Library/Taps/homebrew' % repo) if e.is_dir()}
+        except FileNotFoundError:
+            existing = set()
+        return [tap for tap in Homebrew.taps if tap in existing]
+
     @staticmethod
     def is_applicable():
         global is_global
         if not is_global:
             return False
-        return sh('brew --repo') is not None
+        return _has_tool('brew')
 
     @staticmethod
     def is_online():
-        repo = sh('brew --repo')
-        with cd(repo):
-            repo_online = sh('git remote get-url origin'
-                      ) == 'https://%s/git/homebrew/brew.git' % mirror_root
+        repo = sh_cached(('brew', '--repo'))
+        if repo is None:
+            return False
+        repo_online = _git_origin(repo) == 'https://%s/git/homebrew/brew.git' % mirror_root
         if repo_online:
             return os.environ.get('HOMEBREW_BOTTLE_DOMAIN') == 'https://%s/homebrew-bottles' % mirror_root
         return False
@@ -417,42 +551,41 @@ class Homebrew(Base):
 
     @staticmethod
     def up():
-        repo = sh('brew --repo')
-        with cd(repo):
-            ask_if_change(
-                'Homebrew repo',
-                'https://%s/git/homebrew/brew.git' % mirror_root,
-                'git remote get-url origin',
-                'git remote set-url origin https://%s/git/homebrew/brew.git' %
-                mirror_root)
-        for tap in ('homebrew-core', 'homebrew-python', 'homebrew-science'):
+        repo = sh_cached(('brew', '--repo'))
+        if repo is None:
+            return False
+        ask_if_change(
+            'Homebrew repo',
+            'https://%s/git/homebrew/brew.git' % mirror_root,
+            ('git', '-C', repo, 'remote', 'get-url', 'origin'),
+            ('git', '-C', repo, 'remote', 'set-url', 'origin',
+             'https://%s/git/homebrew/brew.git' % mirror_root),
+            current=_git_origin(repo))
+        for tap in Homebrew.installed_taps(repo):
             tap_path = '%s/Library/Taps/homebrew/%s' % (repo, tap)
-            if os.path.isdir(tap_path):
-                with cd(tap_path):
-                    ask_if_change(
-                        'Homebrew tap %s' % tap,
-                        'https://%s/git/homebrew/%s.git' % (mirror_root, tap),
-                        'git remote get-url origin',
-                        'git remote set-url origin https://%s/git/homebrew/%s.git'
-                        % (mirror_root, tap))
+            ask_if_change(
+                'Homebrew tap %s' % tap,
+                'https://%s/git/homebrew/%s.git' % (mirror_root, tap),
+                ('git', '-C', tap_path, 'remote', 'get-url', 'origin'),
+                ('git', '-C', tap_path, 'remote', 'set-url', 'origin',
+                 'https://%s/git/homebrew/%s.git' % (mirror_root, tap)),
+                current=_git_origin(tap_path))
+        sh_cached.cache_clear()
         set_env('HOMEBREW_BOTTLE_DOMAIN', 'https://%s/homebrew-bottles' % mirror_root)
         return True
 
     @staticmethod
     def down():
-        repo = sh('brew --repo')
-        with cd(repo):
-            sh('git remote set-url origin https://github.com/homebrew/brew.git'
-               )
-            for tap in ('homebrew-core', 'homebrew-python',
-                        'homebrew-science'):
-                tap_path = '%s/Library/Taps/homebrew/%s' % (repo, tap)
-                if os.path.isdir(tap_path):
-                    with cd(tap_path):
-                        sh('git remote set-url origin https://github.com/homebrew/%s.git'
-                           % tap)
-            sh('git remote get-url origin'
-                      ) == 'https://github.com/homebrew/brew.git'
+        repo = sh_cached(('brew', '--repo'))
+        if repo is None:
+            return False
+        sh(('git', '-C', repo, 'remote', 'set-url', 'origin',
+            'https://github.com/homebrew/brew.git'))
+        for tap in Homebrew.installed_taps(repo):
+            tap_path = '%s/Library/Taps/homebrew/%s' % (repo, tap)
+            sh(('git', '-C', tap_path, 'remote', 'set-url', 'origin',
+                'https://github.com/homebrew/%s.git' % tap))
+        sh_cached.cache_clear()
         return remove_env('HOMEBREW_BOTTLE_DOMAIN')
 
 
@@ -464,39 +597,45 @@ class CTAN(Base):
     @staticmethod
     def is_applicable():
         # Works both in global mode or local mode
-        return sh('tlmgr --version') is not None
+        return _has_tool('tlmgr')
 
     @staticmethod
-    def is_online():
+    @functools.lru_cache(maxsize=None)
+    def init_usertree():
+        # Runs once per process, kept out of sh_cached as it changes state
+        sh(('tlmgr', 'init-usertree'))
+
+    @staticmethod
+    def base():
         global is_global
-        base = "tlmgr"
-        if not is_global:
-            # Setup usertree first
-            sh("tlmgr init-usertree")
-            base += " --usermode"
+        if is_global:
+            return ('tlmgr',)
+        # Setup usertree first
+        CTAN.init_usertree()
+        return ('tlmgr', '--usermode')
 
-        return sh(
-            '%s option repository' % base
+    @staticmethod
+    def is_online():
+        return sh_cached(
+            CTAN.base() + ('option', 'repository')
         ) == 'Default package repository (repository): https://mirrors.tuna.tsinghua.edu.cn/CTAN/systems/texlive/tlnet'
 
     @staticmethod
     def up():
-        global is_global
-        base = "tlmgr"
-        if not is_global:
-            base += " --usermode"
-
+        base = CTAN.base()
         return ask_if_change(
             'CTAN mirror',
             'Default package repository (repository): https://mirrors.tuna.tsinghua.edu.cn/CTAN/systems/texlive/tlnet',
-            '%s option repository' % base,
-            '%s option repository https://mirrors.tuna.tsinghua.edu.cn/CTAN/systems/texlive/tlnet' % base
+            base + ('option', 'repository'),
+            base + ('option', 'repository', 'https://mirrors.tuna.tsinghua.edu.cn/CTAN/systems/texlive/tlnet'),
+            current=sh_cached(base + ('option', 'repository'))
         )
 
 
 class Anaconda(Base):
     url_free = 'https://%s/anaconda/pkgs/free/' % mirror_root
     url_main = 'https://%s/anaconda/pkgs/main/' % mirror_root
+    channel_regex = re.compile('%s|%s' % (re.escape(url_free), re.escape(url_main)))
 
 
     @staticmethod
@@ -507,70 +646,78 @@ class Anaconda(Base):
     @staticmethod
     def is_applicable():
         # Works both in global mode and local mode
-        return sh('conda -V') is not None
+        return _has_tool('conda')
 
 
     @staticmethod
     def is_online():
-        cmd = 'conda config --get channels'
+        cmd = ('conda', 'config', '--get', 'channels')
         global is_global
         if is_global:
-            cmd += ' --system'
+            cmd += ('--system',)
 
-        channels = sh(cmd).split('\n')
-        in_channels = 0
-        for line in channels:
-            if Anaconda.url_free in line:
-                in_channels += 1
-            elif Anaconda.url_main in line:
-                in_channels += 1
-        return in_channels == 2
+        channels = sh_cached(cmd)
+        if channels is None:
+            return False
+        # Both channels must be present, duplicates count once
+        return len(set(Anaconda.channel_regex.findall(channels))) == 2
 
 
     @staticmethod
     def up():
-        basecmd = 'conda config'
+        basecmd = ('conda', 'config')
         global is_global
         if is_global:
-            basecmd += ' --system'
-        sh ("%s --add channels %s" % (basecmd, Anaconda.url_free))
-        sh ("%s --add channels %s" % (basecmd, Anaconda.url_main))
+            basecmd += ('--system',)
+        sh(basecmd + ('--add', 'channels', Anaconda.url_free))
+        sh(basecmd + ('--add', 'channels', Anaconda.url_main))
+        sh_cached.cache_clear()
         return True
 
     @staticmethod
     def down():
-        basecmd = 'conda config'
+        basecmd = ('conda', 'config')
         global is_global
         if is_global:
-            basecmd += ' --system'
-        sh ("%s --remove channels %s" % (basecmd, Anaconda.url_free))
-        sh ("%s --remove channels %s" % (basecmd, Anaconda.url_main))
+            basecmd += ('--system',)
+        sh(basecmd + ('--remove', 'channels', Anaconda.url_free))
+        sh(basecmd + ('--remove', 'channels', Anaconda.url_main))
+        sh_cached.cache_clear()
         return True
 
 
 class Debian(Base):
     pools = "main contrib non-free"
-    default_sources = {
-            'http://deb.debian.org/debian': ['', '-updates'],
-            'http://security.debian.org/debian-security': ['main', 'contrib', 'non-free'],
-            }
+    # Mirror specs are (mirror, suffixes) pairs so that templates can be cached
+    @staticmethod
+    def build_default_sources():
+        return (
+                ('http://deb.debian.org/debian', ('', '-updates')),
+                ('http://security.debian.org/debian-security', ('main', 'contrib', 'non-free')),
+            )
 
     @staticmethod
     def build_mirrorspec():
-        return {
-                'https://' + mirror_root + '/debian': ['', '-updates'],
-                'https://' + mirror_root + '/debian-security': ['/updates'],
-            }
+        return (
+                ('https://' + mirror_root + '/debian', ('', '-updates')),
+                ('https://' + mirror_root + '/debian-security', ('/updates',)),
+            )
 
     @classmethod
+    @functools.lru_cache(maxsize=4)
     def build_template(cls, mirrorspecs):
-        release = sh('lsb_release -sc')
-        lines = ['%s %s %s%s %s\n' % (repoType, mirror, release, repo, cls.pools)
-                    for mirror in mirrorspecs
-                    for repo in mirrorspecs[mirror]
-                    for repoType in ['deb', 'deb-src']]
-        tmpl = ''.join(lines)
-        return tmpl
+        release = get_os_release().get('VERSION_CODENAME') or sh_cached(('lsb_release', '-sc'))
+        pools = cls.pools
+        return ''.join('%s %s %s%s %s\n' % (repoType, mirror, release, repo, pools)
+                       for mirror, repos in mirrorspecs
+                       for repo in repos
+                       for repoType in ('deb', 'deb-src'))
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def online_template(cls):
+        # Depends only on mirror_root and the release, both fixed for a run
+        return cls.build_template(cls.build_mirrorspec())
 
     @staticmethod
     def name():
@@ -586,9 +733,10 @@ class Debian(Base):
 
     @classmethod
     def is_online(cls):
+        expected = cls.online_template().splitlines(True)
         with open('/etc/apt/sources.list', 'r') as sl:
-            content = sl.read();
-            return content == cls.build_template(cls.build_mirrorspec())
+            # Stop at the first differing line
+            return all(sl.readline() == line for line in expected) and sl.read(1) == ''
 
     @classmethod
     def up(cls):
@@ -597,9 +745,8 @@ class Debian(Base):
         if not user_prompt():
             return False
         if os.path.isfile('/etc/apt/sources.list'):
-            sh('cp /etc/apt/sources.list /etc/apt/sources.oh-my-tuna.bak.list')
-        with open('/etc/apt/sources.list', 'w') as sl:
-            sl.write(cls.build_template(cls.build_mirrorspec()))
+            cp('/etc/apt/sources.list', '/etc/apt/sources.oh-my-tuna.bak.list')
+        _atomic_write('/etc/apt/sources.list', cls.online_template())
         return True
 
     @classmethod
@@ -609,15 +756,16 @@ class Debian(Base):
         if not user_prompt():
             return False
         if os.path.isfile('/etc/apt/sources.oh-my-tuna.bak.list'):
-            if sh('cp /etc/apt/sources.oh-my-tuna.bak.list /etc/apt/sources.list') is not None:
-                return True
-        with open('/etc/apt/sources.list', 'w') as sl:
-            sl.write(cls.build_template(cls.default_sources))
+            with open('/etc/apt/sources.oh-my-tuna.bak.list') as bak:
+                _atomic_write('/etc/apt/sources.list', bak.read())
+            return True
+        _atomic_write('/etc/apt/sources.list', cls.build_template(cls.build_default_sources()))
         return True
 
 
 def _get_mirror_suffix():
-    uname = sh('uname -m')
+    import platform
+    uname = platform.machine()
     no_suffix_list = ['i386', 'i586', 'i686', 'x86_64', 'amd64']
     if any(map(lambda x: x in uname, no_suffix_list)):
         return ''
@@ -626,14 +774,20 @@ def _get_mirror_suffix():
 
 
 class Ubuntu(Debian):
-    default_sources = { 'http://archive.ubuntu.com/ubuntu' + _get_mirror_suffix(): ['', '-updates', '-security', '-backports'] }
+    repos = ('', '-updates', '-security', '-backports')
     pools = "main multiverse universe restricted"
 
+    @staticmethod
+    def build_default_sources():
+        return (
+                ('http://archive.ubuntu.com/ubuntu' + _get_mirror_suffix(), Ubuntu.repos),
+            )
+
     @staticmethod
     def build_mirrorspec():
-        return {
-                'https://' + mirror_root + '/ubuntu' + _get_mirror_suffix(): ['', '-updates', '-security', '-backports'],
-            }
+        return (
+                ('https://' + mirror_root + '/ubuntu' + _get_mirror_suffix(), Ubuntu.repos),
+            )
 
     @staticmethod
     def name():
@@ -663,33 +817,26 @@ class CentOS(Base):
 
     @staticmethod
     def is_online():
-        mirror_re = re.compile(
-            r"baseurl=https://%s/centos/\$releasever/os/\$basearch/\n" %
-            mirror_root, re.M)
-        ml = open('/etc/yum.repos.d/CentOS-Base.repo', 'r')
-        lines = ml.readlines()
-        result = map(lambda l: re.match(mirror_re, l), lines)
-        result = any(result)
-        ml.close()
-        return result
+        with open('/etc/yum.repos.d/CentOS-Base.repo', 'r') as ml:
+            return any(map(centos_mirror_regex.match, ml))
 
     @staticmethod
     def up():
-        sh('cp /etc/yum.repos.d/CentOS-Base.repo /etc/yum.repos.d/CentOS-Base.repo.bak')
-        sh(r'sed -i -E s/^#?baseurl=https?:\/\/[^\/]+\/(.*)$/baseurl=https:\/\/%s\/\1/g /etc/yum.repos.d/CentOS-Base.repo' % mirror_root.replace('/', r'\/'))
-        sh(r'sed -i -E s/^(mirrorlist=.*)$/#\1/g /etc/yum.repos.d/CentOS-Base.repo')
+        cp('/etc/yum.repos.d/CentOS-Base.repo', '/etc/yum.repos.d/CentOS-Base.repo.bak')
+        sh(('sed', '-i', '-E', r's/^#?baseurl=https?:\/\/[^\/]+\/(.*)$/baseurl=https:\/\/%s\/\1/g' % mirror_root.replace('/', r'\/'), '/etc/yum.repos.d/CentOS-Base.repo'))
+        sh(('sed', '-i', '-E', r's/^(mirrorlist=.*)$/#\1/g', '/etc/yum.repos.d/CentOS-Base.repo'))
 
         return True
 
     @staticmethod
     def down():
         if os.path.isfile('/etc/yum.repos.d/CentOS-Base.repo.bak'):
-            sh('cp /etc/yum.repos.d/CentOS-Base.repo.bak /etc/yum.repos.d/CentOS-Base.repo')
+            cp('/etc/yum.repos.d/CentOS-Base.repo.bak', '/etc/yum.repos.d/CentOS-Base.repo')
             return True
 
 
-        sh(r'sed -i -E s/^#(mirrorlist=.*)$/\1/g /etc/yum.repos.d/CentOS-Base.repo')
-        sh(r'sed -i -E s/^(baseurl=.*)$/#\1/g /etc/yum.repos.d/CentOS-Base.repo')
+        sh(('sed', '-i', '-E', r's/^#(mirrorlist=.*)$/\1/g', '/etc/yum.repos.d/CentOS-Base.repo'))
+        sh(('sed', '-i', '-E', r's/^(baseurl=.*)$/#\1/g', '/etc/yum.repos.d/CentOS-Base.repo'))
         return True
 
 
@@ -708,31 +855,29 @@ class AOSCOS(Base):
 
     @staticmethod
     def is_online():
-        agl_result = sh('env LC_ALL=C apt-gen-list now')
+        agl_result = sh(('env', 'LC_ALL=C', 'apt-gen-list', 'now'))
         if not agl_result:
             return None
-        out_re = re.compile(r"mirrors:.* tuna.*", re.M)
-        match = re.findall(out_re, agl_result)
+        match = aosc_tuna_regex.findall(agl_result)
         return len(match) > 0
 
     @staticmethod
     def up():
-        agl_result = sh('env LC_ALL=C apt-gen-list now')
+        agl_result = sh(('env', 'LC_ALL=C', 'apt-gen-list', 'now'))
         if not agl_result:
             return False
-        out_re = re.compile(r"mirrors: origin$", re.M)
-        match = re.findall(out_re, agl_result)
+        match = aosc_origin_regex.findall(agl_result)
         if len(match) > 0:
-            if not sh('env LC_ALL=C apt-gen-list m tuna'):
+            if not sh(('env', 'LC_ALL=C', 'apt-gen-list', 'm', 'tuna')):
                 return False
         else:
-            if not sh('env LC_ALL=C apt-gen-list m +tuna'):
+            if not sh(('env', 'LC_ALL=C', 'apt-gen-list', 'm', '+tuna')):
                 return False
         return True
 
     @staticmethod
     def down():
-        if not sh('env LC_ALL=C apt-gen-list m -tuna'):
+        if not sh(('env', 'LC_ALL=C', 'apt-gen-list', 'm', '-tuna')):
             return False
         return True
 
@@ -741,6 +886,7 @@ MODULES = [ArchLinux, Homebrew, CTAN, Pypi, Anaconda, Debian, Ubuntu, CentOS, AO
 
 
 def main():
+    import argparse
     parser = argparse.ArgumentParser(
         description='Use TUNA mirrors everywhere when applicable')
     parser.add_argument(
@@ -804,12 +950,16 @@ def main():
                         , 'e')
 
     if args.subcommand == 'status':
-        for m in MODULES:
-            if m.is_applicable():
-                if m.is_online():
-                    m.log('Online', 'o')
-                else:
-                    m.log('Offline')
+        # Probes are independent and mostly wait on subprocesses, run them concurrently
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(MODULES)) as ex:
+            applicable = [m for m, ok in ex.map(lambda m: (m, m.is_applicable()), MODULES) if ok]
+            online = list(ex.map(lambda m: m.is_online(), applicable))
+        for m, is_online in zip(applicable, online):
+            if is_online:
+                m.log('Online', 'o')
+            else:
+                m.log('Offline')
 
 
 if __name__ == "__main__":